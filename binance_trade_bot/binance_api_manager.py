@@ -88,7 +88,7 @@ class BinanceOrderBalanceManager(AbstractOrderBalanceManager):
         """
         with self.cache.open_balances() as cache_balances:
             balance = cache_balances.get(currency_symbol, None)
-            if force or balance is None:
+            if force or balance is None or not self.cache.balances_valid:
                 cache_balances.clear()
                 cache_balances.update(
                     {
@@ -96,6 +96,7 @@ class BinanceOrderBalanceManager(AbstractOrderBalanceManager):
                         for currency_balance in self.binance_client.get_account()["balances"]
                     }
                 )
+                self.cache.mark_balances_updated(refreshed=True)
                 self.logger.debug(f"Fetched all balances: {cache_balances}")
                 if currency_symbol not in cache_balances:
                     cache_balances[currency_symbol] = 0.0
@@ -264,15 +265,15 @@ class BinanceAPIManager:
         Get ticker price of a specific coin
         """
         price = self.cache.ticker_values.get(ticker_symbol, None)
-        if price is None and ticker_symbol not in self.cache.non_existent_tickers:
+        if price is None and not self.cache.is_ticker_non_existent(ticker_symbol):
             self.cache.ticker_values = {
                 ticker["symbol"]: float(ticker["price"]) for ticker in self.binance_client.get_symbol_ticker()
             }
             self.logger.debug(f"Fetched all ticker prices: {self.cache.ticker_values}")
             price = self.cache.ticker_values.get(ticker_symbol, None)
             if price is None:
-                self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched from now on", notification=False)
-                self.cache.non_existent_tickers.add(ticker_symbol)
+                self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched for the next hour", notification=False)
+                self.cache.mark_ticker_non_existent(ticker_symbol)
 
         return price
 
@@ -280,8 +281,8 @@ class BinanceAPIManager:
         """
         Get best ask price of a specific coin
         """
-        price = self.cache.ticker_values_ask.get(ticker_symbol, None)
-        if price is None and ticker_symbol not in self.cache.non_existent_tickers:
+        price = self.cache.get_book_price(ticker_symbol, BinanceCache.BOOK_ASK)
+        if price is None and not self.cache.is_ticker_non_existent(ticker_symbol):
             try:
                 ticker = self.binance_client.get_orderbook_ticker(symbol = ticker_symbol)
                 price = float(ticker['askPrice'])
@@ -291,8 +292,8 @@ class BinanceAPIManager:
                 else:
                     raise e
             if price is None:
-                self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched from now on")
-                self.cache.non_existent_tickers.add(ticker_symbol)
+                self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched for the next hour")
+                self.cache.mark_ticker_non_existent(ticker_symbol)
 
         return price
 
@@ -300,8 +301,8 @@ class BinanceAPIManager:
         """
         Get best bid price of a specific coin
         """
-        price = self.cache.ticker_values_bid.get(ticker_symbol, None)
-        if price is None and ticker_symbol not in self.cache.non_existent_tickers:
+        price = self.cache.get_book_price(ticker_symbol, BinanceCache.BOOK_BID)
+        if price is None and not self.cache.is_ticker_non_existent(ticker_symbol):
             try:
                 ticker = self.binance_client.get_orderbook_ticker(symbol = ticker_symbol)
                 price = float(ticker['bidPrice'])
@@ -311,8 +312,8 @@ class BinanceAPIManager:
                 else:
                     raise e
             if price is None:
-                self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched from now on")
-                self.cache.non_existent_tickers.add(ticker_symbol)
+                self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched for the next hour")
+                self.cache.mark_ticker_non_existent(ticker_symbol)
         
         return price
 
@@ -507,8 +508,7 @@ class BinanceAPIManager:
         origin_symbol = origin_coin.symbol
         target_symbol = target_coin.symbol
 
-        with self.cache.open_balances() as balances:
-            balances.clear()
+        self.cache.invalidate_balances()
 
         origin_balance = self.get_currency_balance(origin_symbol)
         target_balance = self.get_currency_balance(target_symbol)
@@ -584,8 +584,7 @@ class BinanceAPIManager:
         target_symbol = target_coin.symbol
 
         # get fresh balances
-        with self.cache.open_balances() as balances:
-            balances.clear()
+        self.cache.invalidate_balances()
 
         origin_balance = self.get_currency_balance(origin_symbol)
         target_balance = self.get_currency_balance(target_symbol)
@@ -1,10 +1,12 @@
 
-import asyncio
+import logging
+import socket
 import sys
 import threading
 import time
-from contextlib import asynccontextmanager, contextmanager
-from typing import Dict, Set, Tuple, Optional
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import Dict, List, Optional, Set, Tuple
 
 import binance.client
 from binance.exceptions import BinanceAPIException, BinanceRequestException
@@ -14,40 +16,23 @@ from .config import Config
 from .database import Database
 from .logger import Logger
 
-class ThreadSafeAsyncLock:
-    def __init__(self):
-        self._init_lock = threading.Lock()
-        self._async_lock: Optional[asyncio.Lock] = None
-        self.loop: Optional[asyncio.AbstractEventLoop] = None
-
-    def attach_loop(self):
-        with self._init_lock:
-            self._async_lock = asyncio.Lock()
-            self.loop = asyncio.get_running_loop()
-
-    def acquire(self):
-        self.__enter__()
-
-    def release(self):
-        self.__exit__(None, None, None)
-
-    def __enter__(self):
-        self._init_lock.__enter__()
-        if self._async_lock is not None:
-            asyncio.run_coroutine_threadsafe(self._async_lock.__aenter__(), self.loop).result()
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self._async_lock is not None:
-            asyncio.run_coroutine_threadsafe(self._async_lock.__aexit__(exc_type, exc_val, exc_tb), self.loop).result()
-        self._init_lock.__exit__(exc_type, exc_val, exc_tb)
-
-    async def __aenter__(self):
-        await self._async_lock.__aenter__()
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._async_lock.__aexit__(exc_type, exc_val, exc_tb)
+# bookTicker is the most frequent event, fetch symbol, best ask and best bid price with a single call
+_get_book_ticker_fields = itemgetter("s", "a", "b")
 
 class BinanceOrder:  # pylint: disable=too-few-public-methods
+    __slots__ = (
+        "event",
+        "symbol",
+        "side",
+        "order_type",
+        "id",
+        "cumulative_quote_qty",
+        "status",
+        "price",
+        "time",
+        "cumulative_filled_quantity",
+    )
+
     def __init__(self, report):
         self.event = report
         self.symbol = report["symbol"]
@@ -64,62 +49,142 @@ class BinanceOrder:  # pylint: disable=too-few-public-methods
         return f"<BinanceOrder {self.event}>"
 
 
+class NotifyingBinanceWebSocketApiManager(BinanceWebSocketApiManager):
+    """
+    BinanceWebSocketApiManager that wakes up consumers as soon as a stream data or stream signal
+    record is added to its buffers, so they can block instead of polling
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stream_buffer_condition = threading.Condition()
+        super().__init__(*args, **kwargs)
+
+    def add_to_stream_buffer(self, stream_data, stream_buffer_name=False):
+        result = super().add_to_stream_buffer(stream_data, stream_buffer_name)
+        self.wake_stream_buffer_waiters()
+        return result
+
+    def add_to_stream_signal_buffer(self, signal_type=False, stream_id=False, data_record=False):
+        result = super().add_to_stream_signal_buffer(signal_type, stream_id, data_record)
+        self.wake_stream_buffer_waiters()
+        return result
+
+    def wake_stream_buffer_waiters(self):
+        with self.stream_buffer_condition:
+            self.stream_buffer_condition.notify_all()
+
+    def wait_for_stream_buffer(self, timeout: float):
+        with self.stream_buffer_condition:
+            if not self.stream_buffer and not self.stream_signal_buffer:
+                self.stream_buffer_condition.wait(timeout)
+
+
 class BinanceCache:  # pylint: disable=too-few-public-methods
+    BOOK_ASK = 0
+    BOOK_BID = 1
+
+    # seconds before a ticker reported as non-existent is looked up again
+    NON_EXISTENT_TICKER_TTL = 3600
+
     def __init__(self):
         self.ticker_values: Dict[str, float] = {}
-        self.ticker_values_ask: Dict[str, float] = {}
-        self.ticker_values_bid: Dict[str, float] = {}
+        # symbol -> (best ask, best bid), both sides arrive together with every bookTicker event
+        self.ticker_values_book: Dict[str, Tuple[float, float]] = {}
         self._balances: Dict[str, float] = {}
-        self._balances_mutex: ThreadSafeAsyncLock = ThreadSafeAsyncLock()
-        self.non_existent_tickers: Set[str] = set()
+        self._balances_mutex: threading.Lock = threading.Lock()
+        # False until all balances were fetched at once, and again after a userdata reconnect
+        self._balances_valid: bool = False
+        # symbol -> time.monotonic() deadline until which the ticker is considered non-existent
+        self.non_existent_tickers: Dict[str, float] = {}
+        # set on every balances change, consumers wait() on it and clear() it once handled
         self.balances_changed_event = threading.Event()
         self.orders: Dict[str, BinanceOrder] = {}
 
-    def attach_loop(self):
-        self._balances_mutex.attach_loop()
+    def is_ticker_non_existent(self, symbol: str) -> bool:
+        deadline = self.non_existent_tickers.get(symbol, None)
+        return deadline is not None and time.monotonic() < deadline
+
+    def mark_ticker_non_existent(self, symbol: str):
+        self.non_existent_tickers[symbol] = time.monotonic() + self.NON_EXISTENT_TICKER_TTL
+
+    def get_book_price(self, symbol: str, side: int) -> Optional[float]:
+        book = self.ticker_values_book.get(symbol, None)
+        if book is None:
+            return None
+        return book[side]
+
+    @property
+    def balances_valid(self) -> bool:
+        return self._balances_valid
+
+    def mark_balances_updated(self, refreshed=False):
+        """
+        Should be called with balances opened after they were modified,
+        refreshed means all balances were fetched from the exchange
+        """
+        if refreshed:
+            self._balances_valid = True
+        self.balances_changed_event.set()
+
+    def invalidate_balances(self):
+        """
+        Mark balances as stale without dropping them, the next reader refreshes them all at once
+        """
+        with self.open_balances():
+            self._balances_valid = False
 
     @contextmanager
     def open_balances(self):
-        with self._balances_mutex:
-            yield self._balances
-
-    @asynccontextmanager
-    async def open_balances_async(self):
-        async with self._balances_mutex:
+        # writers are rare, so try the uncontended fast path before blocking
+        if not self._balances_mutex.acquire(blocking=False):
+            self._balances_mutex.acquire()
+        try:
             yield self._balances
+        finally:
+            self._balances_mutex.release()
 
 
 class OrderGuard:
-    def __init__(self, pending_orders: Set[Tuple[str, int]], mutex: threading.Lock):
-        self.pending_orders = pending_orders
-        self.mutex = mutex
-        # lock immediately because OrderGuard
-        # should be entered and put tag that shouldn't be missed
-        self.mutex.acquire()
+    def __init__(self, stream_manager: "BinanceStreamManager"):
+        self.stream_manager = stream_manager
+        # the mutex isn't held until the tag is added, instead a pending orders fetch
+        # that happens meanwhile is detected on enter and the order is fetched then
+        self.pending_orders_fetches = stream_manager.pending_orders_fetches
         self.tag = None
 
     def set_order(self, origin_symbol: str, target_symbol: str, order_id: int):
-        self.tag = (origin_symbol + target_symbol, order_id)
+        self.tag = (self.stream_manager.get_pair_id(origin_symbol, target_symbol), order_id)
 
     def __enter__(self):
-        try:
-            if self.tag is None:
-                raise Exception("OrderGuard wasn't properly set")
-            self.pending_orders.add(self.tag)
-        finally:
-            self.mutex.release()
+        if self.tag is None:
+            raise Exception("OrderGuard wasn't properly set")
+        with self.stream_manager.pending_orders_mutex:
+            self.stream_manager.pending_orders.add(self.tag)
+            missed_fetch = self.stream_manager.pending_orders_fetches != self.pending_orders_fetches
+        if missed_fetch:
+            try:
+                self.stream_manager.fetch_pending_order(self.tag)
+            except BaseException:
+                # __exit__ won't run when __enter__ raises, so don't leave the tag behind
+                with self.stream_manager.pending_orders_mutex:
+                    self.stream_manager.pending_orders.discard(self.tag)
+                raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.pending_orders.remove(self.tag)
+        with self.stream_manager.pending_orders_mutex:
+            self.stream_manager.pending_orders.remove(self.tag)
 
 
 class BinanceStreamManager:
     def __init__(self, cache: BinanceCache, config: Config, binance_client: binance.client.Client, db: Database, logger: Logger):
         self.cache = cache
+        self.config = config
         self.db = db
         self.logger = logger
-        self.bw_api_manager = BinanceWebSocketApiManager(
-            output_default="UnicornFy", enable_stream_signal_buffer=True, exchange=f"binance.{config.BINANCE_TLD}"
+        # sampled once so the handlers don't format whole payloads for a disabled debug level
+        self._debug = logger.Logger.isEnabledFor(logging.DEBUG)
+        self.bw_api_manager = NotifyingBinanceWebSocketApiManager(
+            output_default="dict", enable_stream_signal_buffer=True, exchange=f"binance.{config.BINANCE_TLD}"
         )
         self.bw_api_manager.create_stream(
             ["arr"], ["!miniTicker"], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
@@ -129,12 +194,14 @@ class BinanceStreamManager:
         )
 
 
+        coins = self.db.get_coins()
+
         if config.PRICE_TYPE == Config.PRICE_TYPE_ORDERBOOK:
 
             bridge_coin = config.BRIDGE_SYMBOL
             coin_symbols = []
 
-            for coin in self.db.get_coins():
+            for coin in coins:
                 coin_symbols.append(coin.symbol.lower() + bridge_coin.lower())
 
             self.bw_api_manager.create_stream(
@@ -142,93 +209,212 @@ class BinanceStreamManager:
             )
             
         self.binance_client = binance_client
-        self.pending_orders: Set[Tuple[str, int]] = set()
+        # (pair id, order id), pair ids index _pair_symbols
+        self.pending_orders: Set[Tuple[int, int]] = set()
         self.pending_orders_mutex: threading.Lock = threading.Lock()
+        # incremented under pending_orders_mutex every time pending orders are fetched after a reconnect
+        self.pending_orders_fetches: int = 0
+        # tradable pairs are known at startup, so pending order tags are plain int tuples
+        self._pair_ids: Dict[Tuple[str, str], int] = {}
+        self._pair_symbols: List[str] = []
+        self._pair_ids_mutex: threading.Lock = threading.Lock()
+        symbols = [coin.symbol for coin in coins] + [config.BRIDGE_SYMBOL]
+        for origin_symbol in symbols:
+            for target_symbol in symbols:
+                if origin_symbol != target_symbol:
+                    self.get_pair_id(origin_symbol, target_symbol)
+        self._event_handlers = {
+            "executionReport": self._on_execution_report,
+            "balanceUpdate": self._on_balance_update,
+            "outboundAccountPosition": self._on_account_position,
+            "outboundAccountInfo": self._on_account_position,
+        }
+        self._stop_requested = threading.Event()
         self._processorThread = threading.Thread(target=self._stream_processor)
         self._processorThread.start()
 
     def acquire_order_guard(self):
-        return OrderGuard(self.pending_orders, self.pending_orders_mutex)
+        return OrderGuard(self)
+
+    def get_pair_id(self, origin_symbol: str, target_symbol: str) -> int:
+        pair_id = self._pair_ids.get((origin_symbol, target_symbol), None)
+        if pair_id is None:
+            # pairs outside of the configured coins (e.g. BNB top-ups) are registered on first use
+            with self._pair_ids_mutex:
+                pair_id = self._pair_ids.get((origin_symbol, target_symbol), None)
+                if pair_id is None:
+                    pair_id = len(self._pair_symbols)
+                    self._pair_symbols.append(origin_symbol + target_symbol)
+                    self._pair_ids[(origin_symbol, target_symbol)] = pair_id
+        return pair_id
+
+    def _fetch_order(self, symbol: str, order_id: int):
+        while not self._stop_requested.is_set():
+            try:
+                return self.binance_client.get_order(symbol=symbol, orderId=order_id)
+            except (BinanceRequestException, BinanceAPIException) as e:
+                self.logger.error(f"Got exception during fetching pending order: {e}")
+            time.sleep(1)
+        return None
+
+    def fetch_pending_order(self, tag: Tuple[int, int], open_orders: Optional[Dict[Tuple[str, int], dict]] = None):
+        pair_id, order_id = tag
+        symbol = self._pair_symbols[pair_id]
+        order = open_orders.get((symbol, order_id), None) if open_orders is not None else None
+        if order is None:
+            order = self._fetch_order(symbol, order_id)
+            if order is None:  # stream manager is closing
+                return
+        fake_report = {
+            "symbol": order["symbol"],
+            "side": order["side"],
+            "order_type": order["type"],
+            "order_id": order["orderId"],
+            "cumulative_quote_asset_transacted_quantity": float(order["cummulativeQuoteQty"]),
+            "cumulative_filled_quantity": float(order["executedQty"]),
+            "current_order_status": order["status"],
+            "order_price": float(order["price"]),
+            "transaction_time": order["time"],
+        }
+        self.logger.info(f"Pending order {order_id} for symbol {symbol} fetched:\n{fake_report}", False)
+        self.cache.orders[fake_report["order_id"]] = BinanceOrder(fake_report)
 
     def _fetch_pending_orders(self):
-        pending_orders: Set[Tuple[str, int]]
+        pending_orders: Set[Tuple[int, int]]
+        # only copy under the mutex, REST calls below must not block order guards
         with self.pending_orders_mutex:
             pending_orders = self.pending_orders.copy()
-        for (symbol, order_id) in pending_orders:
-            order = None
-            while True:
-                try:
-                    order = self.binance_client.get_order(symbol=symbol, orderId=order_id)
-                except (BinanceRequestException, BinanceAPIException) as e:
-                    self.logger.error(f"Got exception during fetching pending order: {e}")
-                if order is not None:
-                    break
-                time.sleep(1)
-            fake_report = {
-                "symbol": order["symbol"],
-                "side": order["side"],
-                "order_type": order["type"],
-                "order_id": order["orderId"],
-                "cumulative_quote_asset_transacted_quantity": float(order["cummulativeQuoteQty"]),
-                "cumulative_filled_quantity": float(order["executedQty"]),
-                "current_order_status": order["status"],
-                "order_price": float(order["price"]),
-                "transaction_time": order["time"],
-            }
-            self.logger.info(f"Pending order {order_id} for symbol {symbol} fetched:\n{fake_report}", False)
-            self.cache.orders[fake_report["order_id"]] = BinanceOrder(fake_report)
-
-    def _invalidate_balances(self):
-        with self.cache.open_balances() as balances:
-            balances.clear()
+            self.pending_orders_fetches += 1
+        if not pending_orders:
+            return
+        open_orders = None
+        if len(pending_orders) > 1:
+            # one round-trip for everything still open, orders closed in the meantime are fetched one by one
+            pair_ids = {pair_id for pair_id, _ in pending_orders}
+            params = {"symbol": self._pair_symbols[pair_ids.pop()]} if len(pair_ids) == 1 else {}
+            try:
+                open_orders = {
+                    (order["symbol"], order["orderId"]): order
+                    for order in self.binance_client.get_open_orders(**params)
+                }
+            except (BinanceRequestException, BinanceAPIException) as e:
+                self.logger.error(f"Got exception during fetching open orders: {e}")
+        for tag in pending_orders:
+            self.fetch_pending_order(tag, open_orders)
+
+    def _tune_stream_socket(self, stream_id):
+        if not self.config.WS_RCVBUF and not self.config.WS_NODELAY:
+            return
+        websocket = self.bw_api_manager.websocket_list.get(stream_id, None)
+        transport = getattr(websocket, "transport", None)
+        sock = transport.get_extra_info("socket") if transport is not None else None
+        if sock is None:
+            return
+        try:
+            if self.config.WS_RCVBUF:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.config.WS_RCVBUF)
+            if self.config.WS_NODELAY:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            self.logger.warning(f"Could not tune websocket socket options: {e}", False)
+
+    def _process_stream_signal(self, stream_signal):
+        signal_type = stream_signal["type"]
+        stream_id = stream_signal["stream_id"]
+        if signal_type == "CONNECT":
+            self._tune_stream_socket(stream_id)
+            stream_info = self.bw_api_manager.get_stream_info(stream_id)
+            if "!userData" in stream_info["markets"]:
+                self.logger.debug("Connect for userdata arrived", False)
+                self._fetch_pending_orders()
+                self.cache.invalidate_balances()
 
     def _stream_processor(self):
-        while True:
-            if self.bw_api_manager.is_manager_stopping():
-                sys.exit()
-
-            stream_signal = self.bw_api_manager.pop_stream_signal_from_stream_signal_buffer()
-            stream_data = self.bw_api_manager.pop_stream_data_from_stream_buffer()
-
-            if stream_signal is not False:
-                signal_type = stream_signal["type"]
-                stream_id = stream_signal["stream_id"]
-                if signal_type == "CONNECT":
-                    stream_info = self.bw_api_manager.get_stream_info(stream_id)
-                    if "!userData" in stream_info["markets"]:
-                        self.logger.debug("Connect for userdata arrived", False)
-                        self._fetch_pending_orders()
-                        self._invalidate_balances()
-            if stream_data is not False and "event_type" in stream_data:
-                self._process_stream_data(stream_data)
-            if stream_data is False and stream_signal is False:
-                time.sleep(0.01)
+        pop_stream_signal = self.bw_api_manager.pop_stream_signal_from_stream_signal_buffer
+        pop_stream_data = self.bw_api_manager.pop_stream_data_from_stream_buffer
+        process_stream_signal = self._process_stream_signal
+        process_stream_data = self._process_stream_data
+
+        while not self._stop_requested.is_set() and not self.bw_api_manager.is_manager_stopping():
+            # drain everything that is queued before going back to sleep
+            stream_signal = pop_stream_signal()
+            while stream_signal is not False:
+                process_stream_signal(stream_signal)
+                stream_signal = pop_stream_signal()
+            stream_data = pop_stream_data()
+            while stream_data is not False:
+                process_stream_data(stream_data)
+                stream_data = pop_stream_data()
+
+            # park until the websocket manager delivers new data, timeout lets us notice a stopping manager
+            self.bw_api_manager.wait_for_stream_buffer(timeout=1.0)
 
     def _process_stream_data(self, stream_data):
-        event_type = stream_data["event_type"]
-        if event_type == "executionReport":  # !userData
+        # streams deliver Binance's raw payloads: !miniTicker@arr is a bare list,
+        # combined streams (bookTicker of several symbols) wrap the payload with the stream name
+        if isinstance(stream_data, list):
+            self._on_mini_ticker(stream_data)
+            return
+        if "stream" in stream_data:
+            stream_data = stream_data["data"]
+        event_type = stream_data.get("e", None)
+        if event_type is None:
+            # bookTicker payloads carry no event type, anything else is a subscription result
+            if "b" in stream_data:
+                self._on_book_ticker(stream_data)
+            return
+        self._event_handlers.get(event_type, self._on_unknown_event)(stream_data)
+
+    def _on_execution_report(self, stream_data):  # !userData
+        if self._debug:
             self.logger.debug(f"execution report: {stream_data}")
-            order = BinanceOrder(stream_data)
-            self.cache.orders[order.id] = order
-        elif event_type == "balanceUpdate":  # !userData
+        report = {
+            "symbol": stream_data["s"],
+            "side": stream_data["S"],
+            "order_type": stream_data["o"],
+            "order_id": stream_data["i"],
+            "cumulative_quote_asset_transacted_quantity": stream_data["Z"],
+            "cumulative_filled_quantity": stream_data["z"],
+            "current_order_status": stream_data["X"],
+            "order_price": stream_data["p"],
+            "transaction_time": stream_data["T"],
+        }
+        order = BinanceOrder(report)
+        self.cache.orders[order.id] = order
+
+    def _on_balance_update(self, stream_data):  # !userData
+        if self._debug:
             self.logger.debug(f"Balance update: {stream_data}")
-            with self.cache.open_balances() as balances:
-                asset = stream_data["asset"]
-                if asset in balances:
-                    del balances[stream_data["asset"]]
-        elif event_type in ("outboundAccountPosition", "outboundAccountInfo"):  # !userData
-            self.logger.debug(f"{event_type}: {stream_data}")
-            with self.cache.open_balances() as balances:
-                for bal in stream_data["balances"]:
-                    balances[bal["asset"]] = float(bal["free"])
-        elif event_type == "24hrMiniTicker":
-            for event in stream_data["data"]:
-                self.cache.ticker_values[event["symbol"]] = float(event["close_price"])
-        elif event_type == "bookTicker":
-                self.cache.ticker_values_ask[stream_data["symbol"]] = float(stream_data["best_ask_price"])
-                self.cache.ticker_values_bid[stream_data["symbol"]] = float(stream_data["best_bid_price"])
-        else:
-            self.logger.error(f"Unknown event type found: {event_type}\n{stream_data}")
+        cache = self.cache
+        with cache.open_balances() as balances:
+            asset = sys.intern(stream_data["a"])
+            if asset in balances:
+                del balances[asset]
+                cache.mark_balances_updated()
+
+    def _on_account_position(self, stream_data):  # !userData
+        if self._debug:
+            self.logger.debug(f"{stream_data['e']}: {stream_data}")
+        cache = self.cache
+        with cache.open_balances() as balances:
+            balances.update({sys.intern(bal["a"]): float(bal["f"]) for bal in stream_data["B"]})
+            cache.mark_balances_updated()
+
+    def _on_mini_ticker(self, events):
+        # ticker_values may be swapped by REST refreshes, so it is looked up per event
+        # symbols are interned so lookups of already known keys are pointer compares
+        intern = sys.intern
+        self.cache.ticker_values.update({intern(event["s"]): float(event["c"]) for event in events})
+
+    def _on_book_ticker(self, stream_data):
+        symbol, ask_price, bid_price = _get_book_ticker_fields(stream_data)
+        self.cache.ticker_values_book[sys.intern(symbol)] = (float(ask_price), float(bid_price))
+
+    def _on_unknown_event(self, stream_data):
+        self.logger.error(f"Unknown event type found: {stream_data['e']}\n{stream_data}")
 
     def close(self):
         self.bw_api_manager.stop_manager_with_all_streams()
+        self._stop_requested.set()
+        self.bw_api_manager.wake_stream_buffer_waiters()
+        self._processorThread.join()
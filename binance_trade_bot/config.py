@@ -60,6 +60,8 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
             "max_balance_bridge_transfer_funding2main": "10000",
             "min_balance_bridge_main_during_jump": "50",
             "min_balance_bridge_funding_after_jump": "0",
+            "ws_rcvbuf": "0",
+            "ws_nodelay": "true",
         }
 
         if not os.path.exists(CFG_FL_NAME):
@@ -260,3 +262,7 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
         self.AUTO_COIN_SELECTOR_ADD_OWNED_COINS = str(auto_coin_selector_add_owned_coins_str).lower() == "true"
 
         self.USE_FUNDING_WALLET = str(os.environ.get("USE_FUNDING_WALLET") or config.get(USER_CFG_SECTION, "use_funding_wallet")).lower() == "true"
+
+        # websocket socket tuning, ws_rcvbuf 0 keeps kernel receive buffer autotuning
+        self.WS_RCVBUF = int(os.environ.get("WS_RCVBUF") or config.get(USER_CFG_SECTION, "ws_rcvbuf"))
+        self.WS_NODELAY = str(os.environ.get("WS_NODELAY") or config.get(USER_CFG_SECTION, "ws_nodelay")).lower() == "true"